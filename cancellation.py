@@ -0,0 +1,44 @@
+from contextvars import ContextVar
+from threading import Event
+from typing import Optional
+
+
+class JobCancelled(Exception):
+    """Raised by tasks that noticed cancellation of their job"""
+
+
+class CancelToken:
+    """Cooperative cancellation flag shared by the scheduler and the task"""
+
+    def __init__(self):
+        self._event = Event()
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        """Raises JobCancelled if the job was cancelled."""
+
+        if self._event.is_set():
+            raise JobCancelled('Job was cancelled')
+
+
+_current_token: ContextVar[Optional[CancelToken]] = ContextVar(
+    'current_token', default=None
+)
+
+
+def current_token() -> CancelToken:
+    """
+    Returns cancellation token of the job running in the current thread,
+    outside of jobs returns a token that is never cancelled.
+    """
+
+    return _current_token.get() or CancelToken()
+
+
+def set_current_token(token: CancelToken) -> None:
+    _current_token.set(token)
@@ -3,6 +3,16 @@ RENAMED_FILE = 'renamed_doc.txt'
 DIR = 'my_dir'
 RENAMED_DIR = 'my_renamed_dir'
 SAVED_JOBS = 'saved_jobs.pkl'
+SPILL_DIR = 'spilled_jobs'
+RESULTS_DIR = 'job_results'
+RESULTS_MAX_ITEMS = 1000
+RESULTS_MAX_BYTES = 64 * 1024 * 1024
+PROFILE_DIR = 'job_profiles'
+PROFILE_SAMPLE_RATE = 0.01
+PROFILE_TOP_LINES = 20
+RUNTIME_STATS = 'task_stats.json'
+DEFAULT_TASK_ESTIMATE = 1.0
+DURATION_SIGMAS = 3
 TIME_PATTERN = '%d.%m.%Y %H:%M:%S'
 START_TIME = 8
 END_TIME = 20
@@ -1,33 +1,275 @@
+import os
+import sys
+import time
 from datetime import datetime
+from functools import lru_cache
 from threading import Thread, Timer
-from typing import Generator
+from typing import Callable, Generator, Optional, Union
 from uuid import uuid4
+from weakref import WeakValueDictionary
 
+from cancellation import (CancelToken, JobCancelled,
+                          set_current_token)
 from constants import TIME_PATTERN
-from tasks import get_task
+from profiling import JobProfiler
+from results import ResultStore
+from runtime_stats import RuntimeStats
+from tasks import TASKS, get_task
 from utils import logger, coroutine
 
 
+@lru_cache(maxsize=1024)
+def parse_start_time(start_time: str) -> int:
+    """
+    Parses start time in the TIME_PATTERN format to integer epoch seconds,
+    jobs created in bulk usually share the same start time, so it's cached.
+    Raises ValueError if the start time doesn't match the pattern.
+    """
+
+    try:
+        date, clock = start_time.split(' ')
+        day, month, year = map(int, date.split('.'))
+        hour, minute, second = map(int, clock.split(':'))
+    except ValueError:
+        raise ValueError(
+            f'Start time {start_time!r} does not match {TIME_PATTERN!r}'
+        )
+    return int(
+        datetime(year, month, day, hour, minute, second).timestamp()
+    )
+
+
+def _compact_uid(uid: str) -> Union[int, str]:
+    """Stores hex uid as integer, custom uids are kept as strings."""
+
+    if len(uid) == 32:
+        try:
+            compact = int(uid, 16)
+        except ValueError:
+            compact = None
+        if compact is not None and f'{compact:032x}' == uid:
+            return compact
+    return sys.intern(uid)
+
+
+def _from_legacy_state(state: dict) -> dict:
+    """
+    Converts state of the Job pickled before __slots__, when the task
+    was stored as a function, start time as datetime, uid as a string
+    and dependencies as a list of jobs.
+    """
+
+    task = state['task']
+    task_id = next(
+        (name for name, func in TASKS.items() if func is task),
+        task.__name__
+    )
+    start_time = state.get('start_time')
+    return {
+        '_task_id': sys.intern(task_id),
+        '_start_ts': int(start_time.timestamp()) if start_time else 0,
+        'duration': state.get('duration', -1),
+        'restarts': state.get('restarts', 0),
+        '_dependency_ids': tuple(
+            dependency._uid for dependency in state.get('dependencies', ())
+        ),
+        'pass_results': state.get('pass_results', False),
+        '_uid': _compact_uid(state['uid']),
+    }
+
+
 class Job:
+    """
+    Task with its settings. Jobs are compact to keep millions of them
+    in the queue: task is stored by its interned name, start time as epoch
+    seconds, uid as integer and dependencies as a tuple of their uids.
+    """
+
+    __slots__ = (
+        '_task_id', '_start_ts', 'duration', 'restarts', '_dependency_ids',
+        'pass_results', '_uid', 'worker', '_token', '__weakref__'
+    )
+    _registry: 'WeakValueDictionary[Union[int, str], Job]' = (
+        WeakValueDictionary()
+    )
+
     def __init__(self,
                  task: str,
                  uid: str = "",
                  start_time: str = "",
                  duration: int = -1,
                  restarts: int = 0,
-                 dependencies: list = None):
-        self.task = get_task(task)
-        if start_time:
-            self.start_time = datetime.strptime(start_time, TIME_PATTERN)
-        else:
-            self.start_time = None
+                 dependencies: list = None,
+                 pass_results: bool = False):
+        get_task(task)
+        self._task_id = sys.intern(task)
+        self._start_ts = parse_start_time(start_time) if start_time else 0
         self.duration = duration
         self.restarts = restarts
-        self.dependencies = dependencies or []
-        self.uid = uid if uid else uuid4().hex
+        self._dependency_ids = tuple(
+            dependency._uid for dependency in dependencies or ()
+        )
+        self.pass_results = pass_results
+        self._uid = _compact_uid(uid) if uid else uuid4().int
         self.worker = None
+        self._token = None
+        self._registry[self._uid] = self
+
+    @classmethod
+    def create_many(cls,
+                    task: str,
+                    count: int,
+                    start_time: str = "",
+                    duration: int = -1,
+                    restarts: int = 0,
+                    dependencies: list = None,
+                    pass_results: bool = False) -> list['Job']:
+        """
+        Fast constructor for bulk creation of count jobs with the same
+        settings. The task, start time and dependencies are resolved once
+        and uids are taken from one block of random bytes.
+        """
+
+        get_task(task)
+        task_id = sys.intern(task)
+        start_ts = parse_start_time(start_time) if start_time else 0
+        dependency_ids = tuple(
+            dependency._uid for dependency in dependencies or ()
+        )
+        random_bytes = os.urandom(16 * count)
+        jobs = []
+        for index in range(count):
+            job = cls.__new__(cls)
+            job._task_id = task_id
+            job._start_ts = start_ts
+            job.duration = duration
+            job.restarts = restarts
+            job._dependency_ids = dependency_ids
+            job.pass_results = pass_results
+            job._uid = int.from_bytes(
+                random_bytes[index * 16:index * 16 + 16], 'big'
+            )
+            job.worker = None
+            job._token = None
+            cls._registry[job._uid] = job
+            jobs.append(job)
+        return jobs
+
+    @property
+    def task(self) -> Callable:
+        return get_task(self._task_id)
+
+    @property
+    def task_id(self) -> str:
+        return self._task_id
+
+    @property
+    def start_time(self) -> Optional[datetime]:
+        if not self._start_ts:
+            return None
+        return datetime.fromtimestamp(self._start_ts)
+
+    @property
+    def uid(self) -> str:
+        if isinstance(self._uid, int):
+            return f'{self._uid:032x}'
+        return self._uid
 
-    def perform_job(self) -> None:
+    @property
+    def dependency_uids(self) -> list[str]:
+        return [
+            f'{uid:032x}' if isinstance(uid, int) else uid
+            for uid in self._dependency_ids
+        ]
+
+    @property
+    def dependencies(self) -> list['Job']:
+        """
+        Returns the dependency jobs which are still alive in this process,
+        finished and released dependencies are not returned.
+        """
+
+        jobs = (self._registry.get(uid) for uid in self._dependency_ids)
+        return [job for job in jobs if job is not None]
+
+    @property
+    def token(self) -> CancelToken:
+        """Cancellation token of the job, created on the first use."""
+
+        if self._token is None:
+            self._token = CancelToken()
+        return self._token
+
+    def _inputs(self, results: Optional[ResultStore]) -> list:
+        """
+        Returns results of the dependencies in their order if the job
+        takes upstream results as inputs.
+        """
+
+        if not self.pass_results:
+            return []
+        if results is None:
+            raise LookupError('Result store is required for pass_results')
+        inputs = []
+        for uid in self.dependency_uids:
+            handle = results.get(uid)
+            if handle is None:
+                raise LookupError(f'No result for job {uid}')
+            inputs.append(handle.result())
+        return inputs
+
+    def _call_task(self,
+                   results: Optional[ResultStore],
+                   profiler: Optional[JobProfiler]):
+        """Calls the task with its inputs under the profiler if any."""
+
+        if not profiler:
+            return self.task(*self._inputs(results))
+        with profiler.profile(self.uid, self._task_id):
+            return self.task(*self._inputs(results))
+
+    def _execute(self,
+                 results: Optional[ResultStore],
+                 errors: list,
+                 deferred: bool,
+                 profiler: Optional[JobProfiler] = None,
+                 stats: Optional[RuntimeStats] = None) -> None:
+        """
+        Calls the task and stores its result or exception in the result
+        store. A failed attempt is stored only if the job won't be restarted,
+        a cancelled job is never restarted. The task is profiled if the
+        profiler selects the job, runtime of the successful task is recorded
+        to the stats.
+        """
+
+        started_at = time.time()
+        set_current_token(self.token)
+        if results:
+            results.set_running(self.uid, started_at)
+        try:
+            self.token.raise_if_cancelled()
+            value = self._call_task(results, profiler)
+        except JobCancelled:
+            logger.warning('Task "%s" was cancelled.', self.task.__doc__)
+            if results:
+                results.set_cancelled(self.uid, started_at)
+            return
+        except Exception as error:
+            errors.append(error)
+            if deferred:
+                logger.error(error)
+            if results and (deferred or self.restarts <= 0):
+                results.set_exception(self.uid, error, started_at)
+            return
+        if stats:
+            stats.record(self._task_id, time.time() - started_at)
+        if results:
+            results.set_result(self.uid, value, started_at)
+
+    def perform_job(self,
+                    results: Optional[ResultStore] = None,
+                    profiler: Optional[JobProfiler] = None,
+                    stats: Optional[RuntimeStats] = None) -> None:
         """
         1. Retrieves the task name from the docstring of the task object.
         2. If a start time is specified (self.start_at) and that time is in
@@ -41,19 +283,32 @@ class Job:
         5. If the worker thread is still alive after the maximum working time
         has been reached, terminate the thread. Store the worker thread or
         timer in the worker attribute of the Job instance.
+        6. The return value of the task is stored in the results store, if
+        the task raised an exception, it's raised again to restart the job.
+        7. If a profiler is given, the task is profiled in the worker thread.
+        8. If stats are given, runtime of the successful task is recorded.
         """
 
         task_name = self.task.__doc__
+        errors: list = []
         if self.start_time and self.start_time > datetime.now():
             seconds = (self.start_time - datetime.now()).total_seconds()
             logger.info(
                 'Task "%s" will starts at %s.', task_name, self.start_time
             )
-            worker = Timer(seconds, self.task)
+            worker = Timer(
+                seconds, self._execute,
+                args=(results, errors, True, profiler, stats)
+            )
+            self.worker = worker
             worker.start()
         else:
             logger.info('Task "%s" started.', task_name)
-            worker = Thread(target=self.task)
+            worker = Thread(
+                target=self._execute,
+                args=(results, errors, False, profiler, stats)
+            )
+            self.worker = worker
             worker.start()
             if self.duration >= 0:
                 worker.join(self.duration)
@@ -62,38 +317,53 @@ class Job:
                     logger.warning('Task "%s" was terminated.', task_name)
             else:
                 worker.join()
-        self.worker = worker
+        if errors:
+            raise errors[0]
 
     def __getstate__(self):
-        """Get dict with all Job attributes without worker"""
+        """Get dict with all Job attributes without worker and token"""
 
-        state = self.__dict__.copy()
-        state['worker'] = None
-        return state
+        return {
+            name: getattr(self, name) for name in self.__slots__
+            if name not in ('worker', '_token', '__weakref__')
+        }
 
     def __setstate__(self, state):
         """
         Take the dict returned by __getstate__ and use it to set
-        the instance attributes.
+        the instance attributes, restored job gets a new token. The state
+        of jobs saved before __slots__ is converted.
         """
 
-        self.__dict__.update(state)
+        if 'task' in state:
+            state = _from_legacy_state(state)
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.worker = None
+        self._token = None
+        self._registry[self._uid] = self
 
     @staticmethod
     @coroutine
-    def run() -> Generator[None, 'Job', None]:
+    def run(
+        results: Optional[ResultStore] = None,
+        profiler: Optional[JobProfiler] = None,
+        stats: Optional[RuntimeStats] = None
+    ) -> Generator[None, 'Job', None]:
         """
         This is a static method that creates a coroutine generator.
         It runs in an infinite loop and yields control to the calling code
         each time it receives a new job. When a job is received, it is executed
         by calling the perform_job method of the Job object. If the
         execution of the job raises an exception, the method retries the
-        job up to job tries times before giving up.
+        job up to job tries times before giving up. Results of the jobs are
+        stored in the results store, jobs are profiled by the profiler and
+        their runtimes are recorded to the stats.
         """
         while True:
             job = yield
             try:
-                job.perform_job()
+                job.perform_job(results, profiler, stats)
             except GeneratorExit:
                 logger.info('Finished schedule jobs.')
                 raise
@@ -104,10 +374,11 @@ class Job:
                     task_name = job.task.__doc__
                     logger.warning('Task "%s" restarted.', task_name)
                     try:
-                        job.perform_job()
+                        job.perform_job(results, profiler, stats)
                         logger.info(
                             'Task "%s" successful finished.', task_name
                         )
+                        break
                     except Exception as error:
                         logger.error(error)
             finally:
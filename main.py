@@ -1,7 +1,9 @@
 from datetime import datetime, timedelta
 
 from job import Job
+from results import JobResult
 from scheduler import Scheduler
+from utils import logger
 
 if __name__ == '__main__':
 
@@ -12,18 +14,25 @@ if __name__ == '__main__':
     task_5 = Job('task_5', dependencies=[task_1, task_2, task_3, task_4])
     task_6 = Job('task_6', dependencies=[task_5])
     task_7 = Job('task_7', dependencies=[task_5])
-    task_8 = Job('task_8', duration=10)
+    fetch = Job('task_10', duration=10)
+    calculate = Job('task_11', dependencies=[fetch], pass_results=True)
+    report = Job('task_12', dependencies=[calculate], pass_results=True)
     task_9 = Job(
-        'task_9', restarts=3, dependencies=[task_8],
+        'task_9', restarts=3, dependencies=[report],
         start_time=(datetime.now() + timedelta(seconds=5)).strftime(
             '%d.%m.%Y %H:%M:%S'
         )
     )
 
-    scheduler = Scheduler(pool_size=10)
+    scheduler = Scheduler(pool_size=11)
 
     scheduler.schedule([
-        task_1, task_2, task_3, task_4, task_5, task_6, task_7, task_8, task_9
+        task_1, task_2, task_3, task_4, task_5, task_6, task_7,
+        fetch, calculate, report, task_9
     ])
 
     scheduler.run()
+
+    best_city = scheduler.results.get(report.uid)
+    if best_city and best_city.status == JobResult.DONE:
+        logger.info(best_city.result())
@@ -0,0 +1,160 @@
+import cProfile
+import os
+import random
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import count
+from threading import Lock
+from typing import Callable, Iterator, Optional
+
+from constants import PROFILE_DIR, PROFILE_SAMPLE_RATE, PROFILE_TOP_LINES
+from utils import logger
+
+_current_dir: ContextVar[Optional[str]] = ContextVar(
+    'current_profile_dir', default=None
+)
+_tracing_lock = Lock()
+_tracing_jobs = 0
+_started_tracing = False
+_calls = count()
+
+
+def _start_tracing() -> None:
+    """
+    Starts tracemalloc for the first profiled job unless it's already
+    tracing, for example with -X tracemalloc.
+    """
+
+    global _tracing_jobs, _started_tracing
+    with _tracing_lock:
+        if not _tracing_jobs and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _tracing_jobs += 1
+
+
+def _stop_tracing() -> None:
+    """Stops tracemalloc after the last profiled job if it was started here."""
+
+    global _tracing_jobs, _started_tracing
+    with _tracing_lock:
+        _tracing_jobs -= 1
+        if not _tracing_jobs and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+def _write_allocations(before: tracemalloc.Snapshot,
+                       after: tracemalloc.Snapshot,
+                       path: str,
+                       top: int) -> None:
+    """Writes top allocations made between two snapshots."""
+
+    with open(path, 'w', encoding='utf-8') as f:
+        for stat in after.compare_to(before, 'lineno')[:top]:
+            f.write(f'{stat}\n')
+
+
+@contextmanager
+def profile_call(directory: str,
+                 name: str,
+                 top: int = PROFILE_TOP_LINES) -> Iterator[None]:
+    """
+    Profiles the code inside the block of the current thread with cProfile
+    and traces its allocations with tracemalloc. Writes name.pstats and
+    name-allocations.txt to the directory. tracemalloc traces all threads,
+    so allocations of concurrent jobs can be mixed in.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError as error:
+        logger.warning('Couldnt start profiler for %s: %s', name, error)
+        profile = None
+    _start_tracing()
+    before = tracemalloc.take_snapshot()
+    try:
+        yield
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(os.path.join(directory, f'{name}.pstats'))
+        _write_allocations(
+            before, tracemalloc.take_snapshot(),
+            os.path.join(directory, f'{name}-allocations.txt'), top
+        )
+        _stop_tracing()
+
+
+class ProfiledCall:
+    """
+    Picklable wrapper which profiles the function inside the worker
+    process and writes the profile to the directory of the job.
+    """
+
+    def __init__(self, func: Callable, directory: str):
+        self.func = func
+        self.directory = directory
+
+    def __call__(self, *args, **kwargs):
+        name = f'worker-{os.getpid()}-{next(_calls)}'
+        with profile_call(self.directory, name):
+            return self.func(*args, **kwargs)
+
+
+def profile_in_worker(func: Callable) -> Callable:
+    """
+    Wraps the function sent to a worker process, so it is profiled
+    if the current job is profiled, else returns the function unchanged.
+    """
+
+    directory = _current_dir.get()
+    if directory is None:
+        return func
+    return ProfiledCall(func, directory)
+
+
+class JobProfiler:
+    """
+    Opt-in profiling of jobs. Jobs with the listed uids or task names are
+    always profiled, the other ones are sampled with sample_rate.
+    Profiles and top allocations are written to profile_dir/<uid>.
+    """
+
+    def __init__(self,
+                 sample_rate: float = PROFILE_SAMPLE_RATE,
+                 tasks: Optional[set[str]] = None,
+                 uids: Optional[set[str]] = None,
+                 profile_dir: str = PROFILE_DIR,
+                 top: int = PROFILE_TOP_LINES):
+        self.sample_rate = sample_rate
+        self.tasks = tasks or set()
+        self.uids = uids or set()
+        self.profile_dir = profile_dir
+        self.top = top
+
+    def should_profile(self, uid: str, task_name: str) -> bool:
+        return (
+            uid in self.uids
+            or task_name in self.tasks
+            or random.random() < self.sample_rate
+        )
+
+    @contextmanager
+    def profile(self, uid: str, task_name: str) -> Iterator[None]:
+        """Profiles the job if it's selected or sampled."""
+
+        if not self.should_profile(uid, task_name):
+            yield
+            return
+        directory = os.path.join(self.profile_dir, uid)
+        logger.info('Profiling task "%s" to %s', task_name, directory)
+        token = _current_dir.set(directory)
+        try:
+            with profile_call(directory, 'job', self.top):
+                yield
+        finally:
+            _current_dir.reset(token)
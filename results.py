@@ -0,0 +1,313 @@
+import asyncio
+import os
+import pickle
+import sys
+import time
+from collections import OrderedDict
+from threading import Event, Lock
+from typing import Any, Optional
+
+from cancellation import JobCancelled
+from constants import RESULTS_DIR, RESULTS_MAX_BYTES, RESULTS_MAX_ITEMS
+from utils import logger
+
+PICKLE_ERRORS = (pickle.PicklingError, TypeError, AttributeError)
+
+
+class JobResult:
+    """Future-like handle with result and timing of the job"""
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, uid: str):
+        self.uid = uid
+        self.status = self.PENDING
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._value: Any = None
+        self._exception: Optional[BaseException] = None
+        self._event = Event()
+
+    @property
+    def duration(self) -> Optional[float]:
+        """Seconds the job was running, None if it is not finished."""
+
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def done(self) -> bool:
+        return self._event.is_set()
+
+    def cancelled(self) -> bool:
+        return self.status == self.CANCELLED
+
+    def _finish(self,
+                status: str,
+                value: Any,
+                exception: Optional[BaseException],
+                started_at: Optional[float]) -> None:
+        """Stores outcome of the job and wakes up all waiters."""
+
+        self.status = status
+        self._value = value
+        self._exception = exception
+        self.started_at = started_at or self.started_at
+        self.finished_at = time.time()
+        self._event.set()
+
+    def exception(self,
+                  timeout: Optional[float] = None) -> Optional[BaseException]:
+        """
+        Waits up to timeout seconds for the job and returns its exception.
+        Raises TimeoutError if the job is not finished in time.
+        """
+
+        if not self._event.wait(timeout):
+            raise TimeoutError(f'Job {self.uid} is not finished')
+        return self._exception
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        """
+        Waits up to timeout seconds for the job and returns its result.
+        Raises the exception of the job if it failed or JobCancelled if it
+        was cancelled.
+        """
+
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._value
+
+    async def result_async(self, timeout: Optional[float] = None) -> Any:
+        """Coroutine version of result, doesn't block the event loop."""
+
+        return await asyncio.to_thread(self.result, timeout)
+
+    def __getstate__(self):
+        """Get dict with all JobResult attributes without event"""
+
+        state = self.__dict__.copy()
+        state['_event'] = None
+        return state
+
+    def __setstate__(self, state):
+        """
+        Take the dict returned by __getstate__ and restore the event,
+        only finished results are saved.
+        """
+
+        self.__dict__.update(state)
+        self._event = Event()
+        self._event.set()
+
+
+class ResultStore:
+    """
+    Keeps finished job results in the in-memory LRU limited by number
+    of items and estimated memory size. Evicted results are written to disk,
+    flush writes the rest, so results are found by uid after restart.
+    """
+
+    def __init__(self,
+                 max_items: int = RESULTS_MAX_ITEMS,
+                 max_bytes: int = RESULTS_MAX_BYTES,
+                 results_dir: str = RESULTS_DIR):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.results_dir = results_dir
+        self._lock = Lock()
+        self._pending: dict[str, JobResult] = {}
+        self._cache: OrderedDict[str, tuple[JobResult, int]] = OrderedDict()
+        self._cache_bytes = 0
+        self._unsaved: set[str] = set()
+        self._writing: dict[str, JobResult] = {}
+
+    def _path(self, uid: str) -> str:
+        return os.path.join(self.results_dir, f'{uid}.pkl')
+
+    @staticmethod
+    def _size(handle: JobResult) -> int:
+        """
+        Estimates memory of the result and the exception by walking their
+        containers and object attributes, shared objects are counted once.
+        """
+
+        size = 0
+        seen: set[int] = set()
+        stack = [handle._value, handle._exception]
+        while stack:
+            obj = stack.pop()
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            size += sys.getsizeof(obj)
+            if isinstance(obj, (str, bytes, bytearray, int, float)):
+                continue
+            if isinstance(obj, dict):
+                stack.extend(obj.keys())
+                stack.extend(obj.values())
+            elif isinstance(obj, (list, tuple, set, frozenset)):
+                stack.extend(obj)
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+        return size
+
+    def _put(self, handle: JobResult, saved: bool = False) -> None:
+        """
+        Puts handle to the LRU and evicts the oldest ones, the evicted
+        results that are not on disk yet are moved to the writing list.
+        Must be called with the lock held.
+        """
+
+        size = self._size(handle)
+        self._cache[handle.uid] = (handle, size)
+        self._cache_bytes += size
+        if not saved:
+            self._unsaved.add(handle.uid)
+        while self._cache and (len(self._cache) > self.max_items
+                               or self._cache_bytes > self.max_bytes):
+            uid, (evicted, evicted_size) = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted_size
+            if uid in self._unsaved:
+                self._unsaved.discard(uid)
+                self._writing[uid] = evicted
+
+    def _write(self) -> None:
+        """Writes results from the writing list to disk without the lock."""
+
+        with self._lock:
+            writing = list(self._writing.items())
+        if not writing:
+            return
+        os.makedirs(self.results_dir, exist_ok=True)
+        for uid, handle in writing:
+            try:
+                with open(self._path(uid), 'wb') as f:
+                    pickle.dump(handle, f)
+                logger.debug('Result of job %s saved to disk', uid)
+            except (OSError, *PICKLE_ERRORS) as error:
+                logger.error('Couldnt save result of job %s: %s', uid, error)
+            with self._lock:
+                self._writing.pop(uid, None)
+
+    def flush(self) -> None:
+        """Writes all results that are not on disk yet."""
+
+        with self._lock:
+            for uid in self._unsaved:
+                self._writing[uid] = self._cache[uid][0]
+            self._unsaved.clear()
+        self._write()
+
+    def close(self) -> None:
+        """Saves results and forgets handles of the jobs that never ran."""
+
+        self.flush()
+        with self._lock:
+            self._pending.clear()
+
+    def _load(self, uid: str) -> Optional[JobResult]:
+        """Loads saved handle from disk and puts it back to the LRU."""
+
+        try:
+            with open(self._path(uid), 'rb') as f:
+                handle = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError) as error:
+            logger.error('Couldnt load result of job %s: %s', uid, error)
+            return None
+        with self._lock:
+            cached = self._get(uid)
+            if cached is not None:
+                return cached
+            self._put(handle, saved=True)
+        return handle
+
+    def _get(self, uid: str) -> Optional[JobResult]:
+        """Finds handle in memory. Must be called with the lock held."""
+
+        if uid in self._pending:
+            return self._pending[uid]
+        if uid in self._cache:
+            self._cache.move_to_end(uid)
+            return self._cache[uid][0]
+        return self._writing.get(uid)
+
+    def get(self, uid: str) -> Optional[JobResult]:
+        """Finds handle of the job by uid in memory or on disk."""
+
+        with self._lock:
+            handle = self._get(uid)
+        if handle is None:
+            handle = self._load(uid)
+        self._write()
+        return handle
+
+    def future(self, uid: str) -> JobResult:
+        """
+        Creates pending handle of the submitted job. The result of the
+        previous run with the same uid is forgotten, so the caller gets
+        the result of the new run.
+        """
+
+        with self._lock:
+            if uid in self._cache:
+                self._cache_bytes -= self._cache.pop(uid)[1]
+            self._unsaved.discard(uid)
+            self._writing.pop(uid, None)
+            handle = self._pending[uid] = JobResult(uid)
+        try:
+            os.remove(self._path(uid))
+        except FileNotFoundError:
+            pass
+        return handle
+
+    def set_running(self, uid: str, started_at: float) -> None:
+        with self._lock:
+            handle = self._pending.setdefault(uid, JobResult(uid))
+            handle.status = JobResult.RUNNING
+            handle.started_at = started_at
+
+    def _set(self,
+             uid: str,
+             status: str,
+             value: Any,
+             exception: Optional[BaseException],
+             started_at: Optional[float]) -> None:
+        with self._lock:
+            handle = self._pending.pop(uid, None) or JobResult(uid)
+            handle._finish(status, value, exception, started_at)
+            if uid in self._cache:
+                self._cache_bytes -= self._cache.pop(uid)[1]
+            self._put(handle)
+        self._write()
+
+    def set_result(self,
+                   uid: str,
+                   value: Any,
+                   started_at: Optional[float] = None) -> None:
+        """Stores successful result of the job."""
+
+        self._set(uid, JobResult.DONE, value, None, started_at)
+
+    def set_exception(self,
+                      uid: str,
+                      exception: BaseException,
+                      started_at: Optional[float] = None) -> None:
+        """Stores exception of the failed job."""
+
+        self._set(uid, JobResult.FAILED, None, exception, started_at)
+
+    def set_cancelled(self,
+                      uid: str,
+                      started_at: Optional[float] = None) -> None:
+        """Marks the job as cancelled."""
+
+        self._set(uid, JobResult.CANCELLED, None,
+                  JobCancelled(f'Job {uid} was cancelled'), started_at)
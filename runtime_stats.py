@@ -0,0 +1,74 @@
+import json
+import math
+from threading import Lock
+from typing import Optional
+
+from constants import (DEFAULT_TASK_ESTIMATE, DURATION_SIGMAS,
+                       RUNTIME_STATS)
+from utils import logger
+
+
+class RuntimeStats:
+    """
+    Runtime statistics of the tasks by their names, kept with Welford's
+    algorithm and saved to a json file to survive restarts.
+    """
+
+    def __init__(self, path: str = RUNTIME_STATS):
+        self.path = path
+        self._lock = Lock()
+        self._stats: dict[str, list[float]] = {}
+
+    def load(self) -> None:
+        """Loads statistics from the json file if it exists."""
+
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                stats = json.load(f)
+        except FileNotFoundError:
+            logger.debug(f'Couldnt open {self.path}, check file')
+            return
+        except (OSError, ValueError) as error:
+            logger.error('Couldnt load runtime stats: %s', error)
+            return
+        with self._lock:
+            self._stats = stats
+
+    def save(self) -> None:
+        with self._lock:
+            stats = dict(self._stats)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(stats, f)
+        logger.debug('Runtime stats saved')
+
+    def record(self, task_name: str, seconds: float) -> None:
+        """Adds runtime of the successful task run."""
+
+        with self._lock:
+            count, mean, m2 = self._stats.get(task_name, (0, 0.0, 0.0))
+            count += 1
+            delta = seconds - mean
+            mean += delta / count
+            m2 += delta * (seconds - mean)
+            self._stats[task_name] = [count, mean, m2]
+
+    def estimate(self, task_name: str) -> float:
+        """Mean runtime of the task, default estimate if it never ran."""
+
+        with self._lock:
+            stats = self._stats.get(task_name)
+        return stats[1] if stats else DEFAULT_TASK_ESTIMATE
+
+    def suggest_duration(self, task_name: str) -> Optional[int]:
+        """
+        Suggests maximum working time of the task as its mean runtime plus
+        DURATION_SIGMAS standard deviations, None if the task never ran.
+        """
+
+        with self._lock:
+            stats = self._stats.get(task_name)
+        if not stats:
+            return None
+        count, mean, m2 = stats
+        deviation = math.sqrt(m2 / (count - 1)) if count > 1 else mean
+        return math.ceil(mean + DURATION_SIGMAS * deviation)
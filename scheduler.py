@@ -1,18 +1,63 @@
+import asyncio
+import os
 import pickle
+import re
+import time
+from collections import deque
+from heapq import heapify, heappop, heappush
+from itertools import count
 from datetime import datetime
+from threading import Condition, Lock, Timer
 from typing import Optional
 
-from constants import SAVED_JOBS
+from constants import SAVED_JOBS, SPILL_DIR
 from job import Job
+from profiling import JobProfiler
+from results import JobResult, ResultStore
+from runtime_stats import RuntimeStats
 from utils import logger
 
+SPILLED_NAME = re.compile(r'(?P<seq>\d+)_(?P<uid>.+)\.pkl')
+
 
 class Scheduler:
 
-    def __init__(self, pool_size: int = 10):
+    def __init__(self,
+                 pool_size: int = 10,
+                 queue_size: Optional[int] = None,
+                 spill: bool = False,
+                 spill_dir: str = SPILL_DIR,
+                 results: Optional[ResultStore] = None,
+                 profiler: Optional[JobProfiler] = None,
+                 stats: Optional[RuntimeStats] = None,
+                 auto_duration: bool = False):
         self.pool_size = pool_size
-        self.job_manager = Job.run()
+        self.queue_size = queue_size or pool_size
+        self.spill = spill
+        self.spill_dir = spill_dir
+        self.results = results or ResultStore()
+        self.stats = stats or RuntimeStats()
+        self.auto_duration = auto_duration
+        self.job_manager = Job.run(self.results, profiler, self.stats)
         self.queue = []
+        self.running: dict[str, Job] = {}
+        self._not_full = Condition()
+        self._accepting = True
+        self._preempt = False
+        self._deadline: Optional[float] = None
+        self._run_lock = Lock()
+        self._spilled = deque()
+        self._spilled_uids = set()
+        self._spill_seq = 0
+        self._state_loaded = False
+        self._queued: dict[str, Job] = {}
+        self._order: dict[str, int] = {}
+        self._blocked: dict[str, int] = {}
+        self._dependents: dict[str, set[str]] = {}
+        self._paths: dict[str, float] = {}
+        self._paths_stale = False
+        self._ready: list[tuple[float, int, str]] = []
+        self._admitted = count()
 
     @staticmethod
     def save_to_file(queue: list[Job]) -> None:
@@ -41,68 +86,474 @@ class Scheduler:
             logger.debug(f'Couldnt open {SAVED_JOBS}, check file')
             return []
 
-    def schedule(self, job_list: list[Job]) -> None:
+    def load_state(self) -> None:
         """
-        Schedules a list of Job objects.
-        job_list: A list of Job objects that needs to be scheduled.
-        If there are any saved tasks in the binary file, it loads them.
-        For each job in the job_list, it adds the job to the queue.
-        If the queue is full, it logs an error message and skips the job.
-        If the job has a start time in the future, it logs a warning message.
-        Otherwise, it logs an info message that the task has been added to the
-        schedule.
-        """
-
-        self.queue = self.load_from_file()
-        if not self.queue:
-            logger.info('No saved tasks found in %s', SAVED_JOBS)
-            self.queue = []
-        for job in job_list:
-            self.queue.append(job)
-            task_name = job.task.__doc__
-            if self.pool_size < len(self.queue):
-                logger.error(
-                    'Tried schedule "%s", but the queue is full',
-                    task_name
+        Restores the saved queue, the spilled jobs and the runtime stats
+        once per scheduler.
+        Jobs from the binary file are admitted without blocking, the ones
+        that don't fit the queue are spilled even if spilling is disabled.
+        Spilled jobs left on disk by a previous run are paged in by their
+        order.
+        """
+
+        with self._not_full:
+            if self._state_loaded:
+                return
+            self._state_loaded = True
+            self.stats.load()
+            if os.path.isdir(self.spill_dir):
+                for name in sorted(os.listdir(self.spill_dir)):
+                    match = SPILLED_NAME.fullmatch(name)
+                    if not match:
+                        logger.warning(
+                            'Skipped unknown file %s in %s',
+                            name, self.spill_dir
+                        )
+                        continue
+                    self._spilled.append(name)
+                    self._spilled_uids.add(match.group('uid'))
+                    self._spill_seq = max(
+                        self._spill_seq, int(match.group('seq')) + 1
+                    )
+            saved_jobs = self.load_from_file()
+            if not saved_jobs:
+                logger.info('No saved tasks found in %s', SAVED_JOBS)
+            for job in saved_jobs:
+                if not self._admit(job):
+                    logger.warning(
+                        'Queue is full, saved task "%s" spilled to disk',
+                        job.task.__doc__
+                    )
+                    self._spill_job(job)
+                    self._block_dependents(job.uid)
+            self._page_in()
+
+    @staticmethod
+    def _uid_from_name(name: str) -> str:
+        """Returns uid of the job from the spilled file name."""
+
+        return SPILLED_NAME.fullmatch(name).group('uid')
+
+    def _spill_job(self, job: Job) -> None:
+        """Writes job to the spill directory and remembers its place."""
+
+        os.makedirs(self.spill_dir, exist_ok=True)
+        name = f'{self._spill_seq:012d}_{job.uid}.pkl'
+        self._spill_seq += 1
+        with open(os.path.join(self.spill_dir, name), 'wb') as f:
+            pickle.dump(job, f)
+        self._spilled.append(name)
+        self._spilled_uids.add(job.uid)
+        logger.debug('Task "%s" spilled to %s', job.task.__doc__, name)
+
+    def _load_spilled(self, name: str) -> None:
+        """Moves the spilled job from disk to the end of the queue."""
+
+        uid = self._uid_from_name(name)
+        self._spilled.remove(name)
+        self._spilled_uids.discard(uid)
+        path = os.path.join(self.spill_dir, name)
+        try:
+            with open(path, 'rb') as f:
+                job = pickle.load(f)
+            os.remove(path)
+        except (OSError, pickle.UnpicklingError) as error:
+            logger.error('Couldnt page in %s: %s', name, error)
+            self._resolve(uid)
+            return
+        self._enqueue(job)
+        logger.debug('Task "%s" paged in', job.task.__doc__)
+
+    def _page_in(self) -> None:
+        """Moves spilled jobs back to the queue while there is free space."""
+
+        while self._spilled and len(self.queue) < self.queue_size:
+            self._load_spilled(self._spilled[0])
+
+    def _page_in_uid(self, uid: str) -> None:
+        """Moves the spilled job with the uid back to the queue."""
+
+        name = next(
+            name for name in self._spilled
+            if self._uid_from_name(name) == uid
+        )
+        self._load_spilled(name)
+
+    def _enqueue(self, job: Job) -> None:
+        """
+        Appends job to the queue and counts its pending dependencies.
+        If one of them is queued, critical paths are recomputed before
+        the next dispatch, otherwise only the path of the job is computed.
+        """
+
+        uid = job.uid
+        dependencies = set(job.dependency_uids)
+        self.queue.append(job)
+        self._queued[uid] = job
+        self._order[uid] = next(self._admitted)
+        self._blocked[uid] = sum(map(self._is_pending, dependencies))
+        for dependency in dependencies:
+            self._dependents.setdefault(dependency, set()).add(uid)
+        if any(dependency in self._queued for dependency in dependencies):
+            self._paths_stale = True
+        elif not self._paths_stale:
+            self._paths[uid] = self._path(job, self._paths)
+            if not self._blocked[uid]:
+                self._push_ready(uid)
+
+    def _dequeue(self, job: Job) -> None:
+        """Removes job from the queue and its dependency counters."""
+
+        uid = job.uid
+        self.queue.remove(job)
+        del self._queued[uid], self._order[uid], self._blocked[uid]
+        self._paths.pop(uid, None)
+        for dependency in set(job.dependency_uids):
+            dependents = self._dependents[dependency]
+            dependents.discard(uid)
+            if not dependents:
+                del self._dependents[dependency]
+
+    def _block_dependents(self, uid: str) -> None:
+        """Counts the newly admitted job as pending for queued dependents."""
+
+        for dependent in self._dependents.get(uid, ()):
+            self._blocked[dependent] += 1
+
+    def _resolve(self, uid: str) -> None:
+        """
+        Marks the job as not pending anymore, queued dependents without
+        other pending dependencies become ready.
+        """
+
+        for dependent in self._dependents.get(uid, ()):
+            self._blocked[dependent] -= 1
+            if not self._blocked[dependent]:
+                self._push_ready(dependent)
+
+    def _push_ready(self, uid: str) -> None:
+        if not self._paths_stale:
+            heappush(
+                self._ready, (-self._paths[uid], self._order[uid], uid)
+            )
+
+    def _admit(self, job: Job) -> bool:
+        """
+        Adds job to the queue if there is free space, otherwise spills it
+        to disk when spilling is enabled. Must be called with the lock held.
+        If auto_duration is set, the job without duration gets the one
+        suggested by the runtime stats.
+        Returns False if the job was not admitted.
+        """
+
+        task_name = job.task.__doc__
+        if self.auto_duration and job.duration < 0:
+            duration = self.stats.suggest_duration(job.task_id)
+            if duration is not None:
+                job.duration = duration
+        is_full = len(self.queue) >= self.queue_size
+        if is_full and not self.spill:
+            return False
+        if is_full or self.spill and self._spilled:
+            self._spill_job(job)
+        else:
+            self._enqueue(job)
+        self._block_dependents(job.uid)
+        if job.start_time and job.start_time > datetime.now():
+            logger.warning(
+                'Task "%s" added to scheduling at %s',
+                task_name,
+                job.start_time
+            )
+        else:
+            logger.info('Task "%s" is added to the schedule', task_name)
+        return True
+
+    def submit(self,
+               job: Job,
+               block: bool = True,
+               timeout: Optional[float] = None) -> Optional[JobResult]:
+        """
+        Submits one Job object to the bounded queue.
+        If the queue is full and spilling is enabled, the job is written to
+        the spill directory. Otherwise, if block is True, waits up to timeout
+        seconds until get_job frees a place in the queue.
+        Returns the result handle if the job was admitted, else logs an error
+        and returns None.
+        """
+
+        if not self._accepting:
+            logger.error(
+                'Tried schedule "%s", but the scheduler is shutting down',
+                job.task.__doc__
+            )
+            return None
+        self.load_state()
+        with self._not_full:
+            if block and not self.spill:
+                self._not_full.wait_for(
+                    lambda: (not self._accepting
+                             or len(self.queue) < self.queue_size),
+                    timeout
                 )
-                continue
-            if job.start_time and job.start_time > datetime.now():
-                logger.warning(
-                    'Task "%s" added to scheduling at %s',
-                    task_name,
-                    job.start_time
+            if not self._accepting:
+                logger.error(
+                    'Tried schedule "%s", but the scheduler is shutting down',
+                    job.task.__doc__
                 )
-            else:
-                logger.info('Task "%s" is added to the schedule', task_name)
+                return None
+            if self._admit(job):
+                return self.results.future(job.uid)
+        logger.error(
+            'Tried schedule "%s", but the queue is full', job.task.__doc__
+        )
+        return None
+
+    async def submit_async(
+            self,
+            job: Job,
+            timeout: Optional[float] = None) -> Optional[JobResult]:
+        """
+        Coroutine version of submit, waits for a free place in the queue
+        without blocking the event loop.
+        """
+
+        return await asyncio.to_thread(self.submit, job, True, timeout)
+
+    def schedule(self, job_list: list[Job]) -> list[Optional[JobResult]]:
+        """
+        Schedules a list of Job objects.
+        job_list: A list of Job objects that needs to be scheduled.
+        If there are any saved tasks in the binary file, they are loaded
+        once per scheduler.
+        For each job in the job_list, it adds the job to the queue without
+        blocking. If the queue is full, the job is spilled to disk when
+        spilling is enabled, else it logs an error message and skips the job.
+        Returns the result handles of the jobs, None for the skipped ones.
+        """
+
+        self.load_state()
+        return [self.submit(job, block=False) for job in job_list]
+
+    def _is_pending(self, uid: str) -> bool:
+        """Checks if the dependency is queued, spilled or still running."""
+
+        return (
+            uid in self._queued
+            or uid in self._spilled_uids
+            or uid in self.running
+        )
+
+    def _is_cancelled(self, uid: str) -> bool:
+        handle = self.results.get(uid)
+        return bool(handle and handle.cancelled())
+
+    def _is_finished(self, job: Job) -> bool:
+        handle = self.results.get(job.uid)
+        return bool(
+            handle and handle.status in (JobResult.DONE, JobResult.FAILED)
+        )
+
+    def _reap(self) -> None:
+        """
+        Forgets dispatched jobs which workers are finished, jobs which
+        workers are not assigned yet are kept.
+        """
+
+        for uid, job in list(self.running.items()):
+            if job.worker is not None and not job.worker.is_alive():
+                del self.running[uid]
+                self._resolve(uid)
+
+    def _cancel(self, uid: str) -> bool:
+        """
+        Cancels queued, spilled or running job and its queued dependents.
+        Must be called with the lock held.
+        """
+
+        dependents = sorted(
+            self._dependents.get(uid, ()), key=self._order.__getitem__
+        )
+        if uid in self._queued:
+            self._dequeue(self._queued[uid])
+            self._resolve(uid)
+            self.results.set_cancelled(uid)
+        elif uid in self._spilled_uids:
+            name = next(
+                name for name in self._spilled
+                if self._uid_from_name(name) == uid
+            )
+            self._spilled.remove(name)
+            self._spilled_uids.discard(uid)
+            os.remove(os.path.join(self.spill_dir, name))
+            self._resolve(uid)
+            self.results.set_cancelled(uid)
+        elif uid in self.running:
+            job = self.running[uid]
+            job.token.cancel()
+            if isinstance(job.worker, Timer):
+                job.worker.cancel()
+                handle = self.results.get(uid)
+                if handle and handle.status == handle.PENDING:
+                    self.results.set_cancelled(uid)
+        else:
+            return False
+        logger.info('Job %s cancelled', uid)
+        for dependent in dependents:
+            if dependent in self._queued:
+                self._cancel(dependent)
+        return True
+
+    def cancel(self, uid: str) -> bool:
+        """
+        Cancels the job by uid.
+        A queued or spilled job is removed and marked as cancelled, a pending
+        timer is stopped and a running task gets its cancellation token set,
+        so it can stop by checking current_token(). Queued dependents are
+        cancelled too, spilled ones are cancelled when they are paged in.
+        Returns False if the job is not found.
+        """
+
+        with self._not_full:
+            self._reap()
+            cancelled = self._cancel(uid)
+            self._page_in()
+            self._not_full.notify_all()
+        return cancelled
+
+    def _path(self, job: Job, paths: dict[str, float]) -> float:
+        """
+        Remaining critical path of the queued job: its estimated runtime
+        plus the longest path of its queued dependents from paths.
+        """
+
+        return self.stats.estimate(job.task_id) + max(
+            (paths[uid] for uid in self._dependents.get(job.uid, ())),
+            default=0
+        )
+
+    def _update_paths(self) -> None:
+        """
+        Recomputes critical paths of the queued jobs in reverse topological
+        order, so every job is visited after its queued dependents, and
+        rebuilds the heap of the ready jobs.
+        """
+
+        if not self._paths_stale:
+            return
+        waiting = {
+            uid: len(self._dependents.get(uid, ())) for uid in self._queued
+        }
+        stack = [uid for uid, dependents in waiting.items() if not dependents]
+        paths: dict[str, float] = {}
+        while stack:
+            job = self._queued[stack.pop()]
+            paths[job.uid] = self._path(job, paths)
+            for dependency in set(job.dependency_uids):
+                if dependency in waiting:
+                    waiting[dependency] -= 1
+                    if not waiting[dependency]:
+                        stack.append(dependency)
+        for uid, job in self._queued.items():
+            if uid not in paths:
+                logger.warning('Task "%s" has cyclic dependencies',
+                               job.task.__doc__)
+                paths[uid] = self.stats.estimate(job.task_id)
+        self._paths = paths
+        self._ready = [
+            (-paths[uid], self._order[uid], uid)
+            for uid, blocked in self._blocked.items() if not blocked
+        ]
+        heapify(self._ready)
+        self._paths_stale = False
+
+    def _pop_ready(self) -> Optional[Job]:
+        """
+        Returns the ready job with the longest critical path, the first
+        admitted one wins ties. Returns None if no job is ready.
+        """
+
+        self._update_paths()
+        while self._ready:
+            _, order, uid = heappop(self._ready)
+            if self._order.get(uid) == order and not self._blocked[uid]:
+                return self._queued[uid]
+        return None
+
+    def _unblock_spilled(self) -> None:
+        """
+        Spills the first queued job waiting for a spilled dependency and
+        pages the dependency in, so the full queue is not blocked.
+        """
+
+        name = next(
+            (name for name in self._spilled
+             if self._uid_from_name(name) in self._dependents),
+            None
+        )
+        if name is None:
+            return
+        dependents = self._dependents[self._uid_from_name(name)]
+        job = self._queued[min(dependents, key=self._order.__getitem__)]
+        self._dequeue(job)
+        self._spill_job(job)
+        self._load_spilled(name)
 
     def get_job(self) -> Optional[Job]:
         """
-        Returns the next job to run.
-        Checks the first job in the queue and removes it.
+        Returns the next job to run and marks it as running.
+        Takes the ready job with the longest remaining critical path from
+        the queue, pages in spilled jobs and wakes up blocked producers.
+        A job is ready when none of its dependencies is queued, spilled or
+        running.
         If the job's start time has already passed, and it has no dependencies,
         it's returned.
         If the job's start time has not yet arrived, it logs a warning message
         and returns None.
-        If the job has dependencies that are either in the queue or running,
-        it puts the job at the end of the queue and returns None.
+        If no job is ready, returns None. If a queued job waits for a spilled
+        dependency, the job is spilled instead and the dependency is paged in.
+        If any of the dependencies was cancelled, the job is cancelled too.
+        """
+
+        with self._not_full:
+            self._reap()
+            job = self._pop_ready()
+            if job is None:
+                self._unblock_spilled()
+            else:
+                self._dequeue(job)
+                job = self._check_ready(job)
+            self._page_in()
+            self._not_full.notify_all()
+            return job
+
+    def _check_ready(self, job: Job) -> Optional[Job]:
+        """
+        Marks the ready job as running, returns None if it's expired or
+        one of its dependencies was cancelled.
         """
 
-        job = self.queue.pop(0)
         task_name = job.task.__doc__
         if job.start_time and job.start_time < datetime.now():
             logger.warning(
-                'Tried to add task "%s" to the schedule, but time is expired',
+                'Tried to add task "%s" to the schedule, but time is '
+                'expired',
                 task_name
             )
-            return None
-        if job.dependencies:
-            for dependency in job.dependencies:
-                if (dependency in self.queue
-                        or dependency.worker
-                        and dependency.worker.is_alive()):
-                    self.queue.append(job)
-                    return None
-        return job
+            self.results.set_exception(
+                job.uid, RuntimeError(f'Start time of "{task_name}" '
+                                      f'is expired')
+            )
+        elif any(map(self._is_cancelled, job.dependency_uids)):
+            logger.warning(
+                'Task "%s" cancelled with its dependency', task_name
+            )
+            self.results.set_cancelled(job.uid)
+        else:
+            self.running[job.uid] = job
+            return job
+        self._resolve(job.uid)
+        return None
 
     def run(self) -> None:
         """
@@ -112,15 +563,126 @@ class Scheduler:
         It continues to get jobs from the queue until either the queue is empty
         or the pool size is reached.
         If a job is obtained, it sends it to the job manager to run it.
-        Finally, it saves the remaining jobs in the queue to the binary file.
+        Only one run is active at a time. During shutdown it stops
+        dispatching when jobs are preempted or the drain timeout passed.
+        Finally, it saves the remaining jobs in the queue to the binary file
+        and the results to the results directory, spilled jobs stay in the
+        spill directory. The state is not saved once shutdown has started,
+        shutdown saves it itself.
         """
 
+        with self._run_lock:
+            self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Body of run, must be called with the run lock held."""
+
         count = 0
         if self.queue:
             logger.info('Starting schedule jobs.')
-        while self.queue and count < self.pool_size:
+        while (self.queue and count < self.pool_size
+               and not self._preempt
+               and self._remaining(self._deadline) != 0):
             job = self.get_job()
             if job:
                 count += 1
                 self.job_manager.send(job)
-        self.save_to_file(self.queue)
+                with self._not_full:
+                    self._reap()
+        if not self._accepting:
+            return
+        with self._not_full:
+            self.save_to_file(self.queue)
+        self.results.flush()
+        self.stats.save()
+
+    @staticmethod
+    def _remaining(deadline: Optional[float]) -> Optional[float]:
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
+
+    def _preempt_running(self, deadline: Optional[float]) -> list[Job]:
+        """
+        Stops dispatching, cancels running jobs and waits for them until
+        the deadline. Returns the preempted jobs.
+        """
+
+        self._preempt = True
+        with self._not_full:
+            self._reap()
+            preempted = list(self.running.values())
+        for job in preempted:
+            job.token.cancel()
+            if isinstance(job.worker, Timer):
+                job.worker.cancel()
+        for job in preempted:
+            if job.worker is not None:
+                job.worker.join(self._remaining(deadline))
+            logger.warning('Task "%s" was preempted.', job.task.__doc__)
+        return preempted
+
+    def _acquire_run(self, deadline: Optional[float]) -> bool:
+        """Waits until the deadline for the active run to return."""
+
+        remaining = self._remaining(deadline)
+        return self._run_lock.acquire(
+            timeout=-1 if remaining is None else remaining
+        )
+
+    def _close_job_manager(self, deadline: Optional[float]) -> None:
+        """Closes the job manager after the active run returns."""
+
+        if not self._acquire_run(deadline):
+            logger.warning('Run is still active, job manager is not closed')
+            return
+        try:
+            self.job_manager.close()
+        finally:
+            self._run_lock.release()
+
+    def shutdown(self,
+                 drain: bool = True,
+                 timeout: Optional[float] = None) -> None:
+        """
+        Stops the scheduler.
+        New jobs are not admitted anymore. If drain is True, the queued jobs
+        are run and running jobs are awaited until timeout seconds pass.
+        Jobs that are still running after that are preempted: pending timers
+        are stopped and running tasks get their cancellation token set and
+        timeout seconds to finish.
+        Queued and preempted jobs are saved to the binary file to be
+        continued after restart, spilled jobs stay in the spill directory.
+        It's safe to call while run is active in another thread, the job
+        manager is closed after that run returns.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._not_full:
+            self._accepting = False
+            self._deadline = deadline
+            self._not_full.notify_all()
+        logger.info('Scheduler is shutting down, drain=%s', drain)
+        if drain:
+            while (self.queue and self._remaining(deadline) != 0
+                   and self._acquire_run(deadline)):
+                try:
+                    self._dispatch()
+                finally:
+                    self._run_lock.release()
+            for job in list(self.running.values()):
+                if job.worker is not None:
+                    job.worker.join(self._remaining(deadline))
+        preempted = self._preempt_running(deadline)
+        with self._not_full:
+            unfinished = [
+                job for job in preempted
+                if not self._is_finished(job)
+            ]
+            self.save_to_file(unfinished + self.queue)
+            self.running.clear()
+        self.results.close()
+        self.stats.save()
+        self._close_job_manager(deadline)
+        logger.info('Scheduler stopped, %s jobs saved',
+                    len(unfinished) + len(self.queue))
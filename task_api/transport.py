@@ -0,0 +1,169 @@
+from array import array
+from multiprocessing import shared_memory
+from typing import NamedTuple
+
+from constants import CONDITIONS, END_TIME, START_TIME
+from task_api.models import CityModel, FinalResultsModel
+from utils import logger
+
+ALIGNMENT = 8
+
+
+class BufferLayout(NamedTuple):
+    """Byte offsets and lengths of the columns in the shared buffer"""
+
+    cities: int
+    days: int
+    hours: int
+    city_days: int
+    day_hours: int
+    hour: int
+    temp: int
+    good: int
+    average_temp: int
+    good_hours: int
+    size: int
+
+
+def _aligned(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _columns(buf: memoryview, layout: BufferLayout) -> dict:
+    """Returns typed views of the columns without copying the buffer."""
+
+    def column(offset: int, length: int, code: str) -> memoryview:
+        size = array(code).itemsize
+        return buf[offset:offset + length * size].cast(code)
+
+    return {
+        'city_days': column(layout.city_days, layout.cities + 1, 'q'),
+        'day_hours': column(layout.day_hours, layout.days + 1, 'q'),
+        'hour': column(layout.hour, layout.hours, 'i'),
+        'temp': column(layout.temp, layout.hours, 'i'),
+        'good': column(layout.good, layout.hours, 'B'),
+        'average_temp': column(layout.average_temp, layout.cities, 'd'),
+        'good_hours': column(layout.good_hours, layout.cities, 'q'),
+    }
+
+
+def _release(columns: dict) -> None:
+    for view in columns.values():
+        view.release()
+
+
+def _average(total: float, count: int) -> float:
+    """Same rounding as DataCalculationTask.calculating_average_temp."""
+
+    if not count:
+        return 0
+    return round(total / count, 1)
+
+
+class SharedForecastsBuffer:
+    """
+    Packs hourly forecasts of the cities once into a columnar shared memory
+    buffer with a preallocated result array. Worker processes get only
+    the buffer name, its layout and the city index, read the columns and
+    write results in place without pickling the models.
+    """
+
+    def __init__(self, forecasts: list[CityModel]):
+        self.cities = [city_data.city for city_data in forecasts]
+        city_days, day_hours = array('q', [0]), array('q', [0])
+        hours, temps, good = array('i'), array('i'), array('B')
+        for city_data in forecasts:
+            for day in city_data.forecasts.forecasts:
+                for hour in day.hours:
+                    hours.append(hour.hour)
+                    temps.append(hour.temp)
+                    good.append(hour.condition in CONDITIONS)
+                day_hours.append(len(hours))
+            city_days.append(len(day_hours) - 1)
+
+        offsets = []
+        offset = 0
+        for column in (city_days, day_hours, hours, temps, good):
+            offsets.append(offset)
+            offset = _aligned(offset + len(column) * column.itemsize)
+        average_offset = offset
+        good_hours_offset = _aligned(offset + len(self.cities) * 8)
+        size = _aligned(good_hours_offset + len(self.cities) * 8)
+        self.layout = BufferLayout(
+            len(self.cities), len(day_hours) - 1, len(hours), *offsets,
+            average_offset, good_hours_offset, size
+        )
+
+        logger.debug('Packing %s hours to shared memory', len(hours))
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        columns = _columns(self.shm.buf, self.layout)
+        try:
+            for name, column in (('city_days', city_days),
+                                 ('day_hours', day_hours),
+                                 ('hour', hours), ('temp', temps),
+                                 ('good', good)):
+                columns[name][:] = column
+        finally:
+            _release(columns)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def __enter__(self) -> 'SharedForecastsBuffer':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shm.close()
+        self.shm.unlink()
+
+    @staticmethod
+    def calculate_city(name: str, layout: BufferLayout, index: int) -> None:
+        """
+        Calculates average temp and good conditions hours of the city
+        in the worker process the same way as DataCalculationTask and
+        writes them to the result array.
+        """
+
+        shm = shared_memory.SharedMemory(name=name)
+        columns = _columns(shm.buf, layout)
+        try:
+            day_hours, hours = columns['day_hours'], columns['hour']
+            temps, good = columns['temp'], columns['good']
+            averages = []
+            total_good_hours = 0
+            for day in range(columns['city_days'][index],
+                             columns['city_days'][index + 1]):
+                temps_sum = temps_count = good_hours = 0
+                for position in range(day_hours[day], day_hours[day + 1]):
+                    if START_TIME < hours[position] < END_TIME:
+                        temps_sum += temps[position]
+                        temps_count += 1
+                        good_hours += good[position]
+                average = _average(temps_sum, temps_count)
+                if average != 0.0:
+                    averages.append(average)
+                    total_good_hours += good_hours
+            columns['average_temp'][index] = _average(
+                sum(averages), len(averages)
+            )
+            columns['good_hours'][index] = total_good_hours
+        finally:
+            _release(columns)
+            shm.close()
+
+    def results(self) -> list[FinalResultsModel]:
+        """Builds final results of the cities from the result array."""
+
+        columns = _columns(self.shm.buf, self.layout)
+        try:
+            return [
+                FinalResultsModel(
+                    city=city,
+                    total_average_temp=columns['average_temp'][index],
+                    total_good_conditions_hours=columns['good_hours'][index]
+                )
+                for index, city in enumerate(self.cities)
+            ]
+        finally:
+            _release(columns)
@@ -3,11 +3,15 @@ import os
 import shutil
 import threading
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 from typing import Callable
 
 from constants import DIR, RENAMED_FILE, FILE, RENAMED_DIR, CITIES
+from profiling import profile_in_worker
+from task_api.models import CityModel, RatingCityListModel
 from task_api.tasks import (DataFetchingTask, DataCalculationTask,
                             DataAggregationTask, DataAnalyzingTask)
+from task_api.transport import SharedForecastsBuffer
 from utils import logger
 
 
@@ -85,39 +89,68 @@ def task_7():
 def task_8():
     """Make request, get API data, analysing and return answer"""
 
+    result = task_12(task_11(task_10()))
+    logger.info(f'Done {task_8.__doc__}')
+    return result
+
+
+def task_9():
+    """Delete report.json"""
+
+    try:
+        os.remove('report.json')
+        logger.info(f'Done {task_9.__doc__}')
+    except Exception as error:
+        logger.info(f'{error} {task_9.__doc__}')
+
+
+def task_10():
+    """Make requests and get API data for all cities"""
+
     logger.debug('Running ThreadPoolExecutor() for make_request')
     with ThreadPoolExecutor() as pool:
-        forecasts = pool.map(DataFetchingTask().make_request, CITIES.keys())
-        logger.info(f'Done {task_8.__doc__}')
+        forecasts = list(
+            pool.map(DataFetchingTask().make_request, CITIES.keys())
+        )
+    logger.info(f'Done {task_10.__doc__}')
+    return forecasts
+
+
+def task_11(forecasts: list[CityModel]) -> RatingCityListModel:
+    """Calculate weather and rating for cities"""
 
     logger.debug('Running ProcessPoolExecutor() for cities models')
     cores_count = multiprocessing.cpu_count()
-    with ProcessPoolExecutor(max_workers=cores_count - 1) as executor:
-        data = executor.map(
-            DataCalculationTask().general_calculation, forecasts
-        )
+    workers = max(cores_count - 1, 1)
+    with SharedForecastsBuffer(forecasts) as buffer:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(
+                profile_in_worker(partial(
+                    SharedForecastsBuffer.calculate_city,
+                    buffer.name, buffer.layout
+                )),
+                range(len(forecasts)),
+                chunksize=max(len(forecasts) // (workers * 4), 1)
+            ))
+        data = buffer.results()
 
     logger.debug('Add rating for cities')
     result_data = DataCalculationTask().adding_rating(data)
+    logger.info(f'Done {task_11.__doc__}')
+    return result_data
+
+
+def task_12(result_data: RatingCityListModel) -> str:
+    """Save report and return the best city"""
 
     logger.debug('Write results to json file')
     DataAggregationTask(threading.RLock()).save_results_to_json(result_data)
 
     logger.debug('Return the best city by weather conditions')
-    logger.info(f'Done {task_8.__doc__}')
+    logger.info(f'Done {task_12.__doc__}')
     return DataAnalyzingTask().get_result(result_data)
 
 
-def task_9():
-    """Delete report.json"""
-
-    try:
-        os.remove('report.json')
-        logger.info(f'Done {task_9.__doc__}')
-    except Exception as error:
-        logger.info(f'{error} {task_9.__doc__}')
-
-
 def get_task(task_name: str) -> Callable:
     return TASKS[task_name]
 
@@ -131,5 +164,8 @@ TASKS = {
     'task_6': task_6,
     'task_7': task_7,
     'task_8': task_8,
-    'task_9': task_9
+    'task_9': task_9,
+    'task_10': task_10,
+    'task_11': task_11,
+    'task_12': task_12
 }
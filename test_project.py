@@ -1,10 +1,42 @@
+import asyncio
 import os
+import pickle
+import shutil
+import time
+import tracemalloc
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
 from threading import Thread
 
-from constants import RENAMED_FILE, FILE
+import pytest
+
+from cancellation import current_token
+from constants import RENAMED_FILE, FILE, RESULTS_DIR, RUNTIME_STATS
 from job import Job
+from profiling import JobProfiler, profile_in_worker
+from results import JobResult, ResultStore
+from runtime_stats import RuntimeStats
 from scheduler import Scheduler
+from task_api.models import CityModel
+from task_api.tasks import DataCalculationTask
+from tasks import TASKS, task_11
+
+
+def answer():
+    return 21
+
+
+def double(value):
+    return value * 2
+
+
+def sleep_a_second():
+    time.sleep(1)
+
+
+def abs_in_worker():
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return list(executor.map(profile_in_worker(abs), [-1, -2]))
 
 
 def test_scheduler():
@@ -70,8 +102,474 @@ def test_job_perform_with_thread():
     assert not job.worker.is_alive()
 
 
+def test_scheduler_bounded_queue():
+    """Test queue should not grow over queue_size."""
+
+    scheduler = Scheduler(pool_size=1)
+    scheduler.schedule([Job('task_1'), Job('task_1')])
+    assert len(scheduler.queue) == 1
+
+
+def test_scheduler_spill_and_page_in(tmp_path):
+    """Test overflow jobs are spilled to disk and paged back in order."""
+
+    jobs = [Job('task_1') for _ in range(3)]
+    scheduler = Scheduler(pool_size=1, spill=True, spill_dir=str(tmp_path))
+    scheduler.schedule(jobs)
+    assert scheduler.queue == [jobs[0]]
+    assert len(os.listdir(tmp_path)) == 2
+
+    assert scheduler.get_job() == jobs[0]
+    assert [job.uid for job in scheduler.queue] == [jobs[1].uid]
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_scheduler_submit_backpressure():
+    """Test submit waits for a free place and gives up after timeout."""
+
+    scheduler = Scheduler(pool_size=1)
+    assert scheduler.submit(Job('task_1'))
+    assert not scheduler.submit(Job('task_1'), timeout=0.1)
+    scheduler.get_job()
+    assert asyncio.run(scheduler.submit_async(Job('task_1'), timeout=0.1))
+
+
+def test_scheduler_restores_jobs_over_queue_size(tmp_path):
+    """Test saved jobs that don't fit the queue are spilled, not lost."""
+
+    Scheduler.save_to_file([Job('task_1') for _ in range(5)])
+    scheduler = Scheduler(pool_size=2, spill_dir=str(tmp_path))
+    scheduler.load_state()
+    assert len(scheduler.queue) == 2
+    assert len(os.listdir(tmp_path)) == 3
+    while scheduler.queue:
+        scheduler.run()
+    assert not os.listdir(tmp_path)
+    assert Scheduler.load_from_file() == []
+
+
+def test_scheduler_pages_in_spilled_dependency(tmp_path):
+    """Test dependents of a spilled job don't block the full queue."""
+
+    upstream = Job('task_1')
+    dependents = [Job('task_1', dependencies=[upstream]) for _ in range(2)]
+    scheduler = Scheduler(pool_size=2, spill=True, spill_dir=str(tmp_path))
+    handles = scheduler.schedule(dependents + [upstream])
+    assert upstream not in scheduler.queue
+    scheduler.run()
+    scheduler.run()
+    assert all(handle.done() for handle in handles)
+
+
+def test_scheduler_skips_unknown_spilled_files(tmp_path):
+    """Test stray files in the spill directory don't break startup."""
+
+    (tmp_path / '.DS_Store').write_text('')
+    (tmp_path / 'notes.pkl').write_text('')
+    scheduler = Scheduler(pool_size=1, spill=True, spill_dir=str(tmp_path))
+    scheduler.load_state()
+    assert not scheduler.queue
+
+
+def test_job_result_handle():
+    """Test submitted job returns handle with result and timing."""
+
+    scheduler = Scheduler(pool_size=1)
+    handle = scheduler.submit(Job('task_1'))
+    assert handle.status == JobResult.PENDING
+    scheduler.run()
+    assert handle.result(timeout=1) is None
+    assert handle.status == JobResult.DONE
+    assert handle.duration is not None
+
+
+def test_job_pass_results(monkeypatch):
+    """Test dependent job receives result of upstream job."""
+
+    monkeypatch.setitem(TASKS, 'answer', lambda: 21)
+    monkeypatch.setitem(TASKS, 'double', lambda value: value * 2)
+    upstream = Job('answer')
+    downstream = Job('double', dependencies=[upstream], pass_results=True)
+    scheduler = Scheduler(pool_size=2)
+    handles = scheduler.schedule([upstream, downstream])
+    scheduler.run()
+    assert handles[1].result(timeout=1) == 42
+    assert scheduler.results.get(downstream.uid) is handles[1]
+
+
+def test_job_result_exception(monkeypatch):
+    """Test failed job stores exception after all restarts."""
+
+    def fail():
+        raise ValueError('boom')
+
+    monkeypatch.setitem(TASKS, 'fail', fail)
+    scheduler = Scheduler(pool_size=1)
+    handle = scheduler.submit(Job('fail', restarts=1))
+    scheduler.run()
+    assert isinstance(handle.exception(timeout=1), ValueError)
+    assert handle.status == JobResult.FAILED
+
+
+def test_result_store_spill_to_disk(tmp_path):
+    """Test evicted results are spilled to disk and found by uid."""
+
+    store = ResultStore(max_items=1, results_dir=str(tmp_path))
+    store.set_result('first', 1)
+    store.set_result('second', 2)
+    assert os.listdir(tmp_path) == ['first.pkl']
+    assert store.get('first').result() == 1
+    store.flush()
+    assert sorted(os.listdir(tmp_path)) == ['first.pkl', 'second.pkl']
+
+
+def test_result_store_counts_nested_size(tmp_path):
+    """Test byte limit counts values inside containers."""
+
+    store = ResultStore(max_bytes=10 * 1024 * 1024,
+                        results_dir=str(tmp_path))
+    for index in range(20):
+        store.set_result(str(index), [str(index) * 1024 * 1024])
+    store.flush()
+    assert len(store._cache) < 10
+    assert store.get('0').result() == ['0' * 1024 * 1024]
+
+
+def test_resubmitted_uid_gets_new_handle(monkeypatch):
+    """Test resubmitted job with the same uid returns the new result."""
+
+    monkeypatch.setitem(TASKS, 'answer', answer)
+    monkeypatch.setitem(TASKS, 'double', lambda: 2)
+    scheduler = Scheduler(pool_size=1)
+    first = scheduler.submit(Job('answer', uid='reused'))
+    scheduler.run()
+    second = scheduler.submit(Job('double', uid='reused'))
+    scheduler.run()
+    assert first.result(timeout=1) == 21
+    assert second.result(timeout=1) == 2
+    assert scheduler.results.get('reused') is second
+
+
+def test_result_store_restart(monkeypatch, tmp_path):
+    """Test restored dependent gets upstream result after restart."""
+
+    monkeypatch.setitem(TASKS, 'answer', answer)
+    monkeypatch.setitem(TASKS, 'double', double)
+    upstream = Job('answer')
+    downstream = Job('double', dependencies=[upstream], pass_results=True)
+    scheduler = Scheduler(
+        pool_size=1, queue_size=2,
+        results=ResultStore(results_dir=str(tmp_path))
+    )
+    scheduler.schedule([upstream, downstream])
+    scheduler.run()
+    scheduler.shutdown(drain=False)
+
+    restarted = Scheduler(
+        pool_size=1, results=ResultStore(results_dir=str(tmp_path))
+    )
+    restarted.load_state()
+    assert [job.uid for job in restarted.queue] == [downstream.uid]
+    restarted.run()
+    assert restarted.results.get(downstream.uid).result(timeout=1) == 42
+
+
+def test_scheduler_cancel_cascades():
+    """Test cancelling queued job cancels its dependents."""
+
+    task_1 = Job('task_1')
+    task_2 = Job('task_2', dependencies=[task_1])
+    task_3 = Job('task_3')
+    scheduler = Scheduler(pool_size=3)
+    handles = scheduler.schedule([task_1, task_2, task_3])
+    assert scheduler.cancel(task_1.uid)
+    assert scheduler.queue == [task_3]
+    assert handles[0].cancelled() and handles[1].cancelled()
+    assert not scheduler.cancel(task_1.uid)
+
+
+def test_scheduler_cancel_running_job(monkeypatch):
+    """Test running task stops when it checks its cancellation token."""
+
+    def wait_for_cancel():
+        token = current_token()
+        while not token.is_cancelled():
+            time.sleep(0.01)
+        token.raise_if_cancelled()
+
+    monkeypatch.setitem(TASKS, 'wait', wait_for_cancel)
+    job = Job('wait')
+    scheduler = Scheduler(pool_size=1)
+    handle = scheduler.submit(job)
+    runner = Thread(target=scheduler.run, daemon=True)
+    runner.start()
+    deadline = time.monotonic() + 5
+    while handle.status != JobResult.RUNNING:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert scheduler.cancel(job.uid)
+    runner.join(timeout=1)
+    assert not runner.is_alive()
+    assert handle.cancelled()
+
+
+def test_scheduler_shutdown_saves_pending_jobs(tmp_path):
+    """Test shutdown without drain stops timers and saves pending jobs."""
+
+    timer_job = Job('task_1',
+                    start_time=(datetime.now() + timedelta(seconds=5)
+                                ).strftime('%d.%m.%Y %H:%M:%S'))
+    scheduler = Scheduler(
+        pool_size=1, queue_size=2,
+        stats=RuntimeStats(str(tmp_path / 'stats.json'))
+    )
+    scheduler.schedule([timer_job, Job('task_3')])
+    scheduler.run()
+    scheduler.shutdown(drain=False, timeout=1)
+    assert not timer_job.worker.is_alive()
+    saved = Scheduler.load_from_file()
+    assert [job.uid for job in saved][0] == timer_job.uid
+    assert len(saved) == 2
+    assert scheduler.submit(Job('task_1')) is None
+    Scheduler.save_to_file([])
+
+
+def test_scheduler_shutdown_drain():
+    """Test shutdown with drain runs all queued jobs."""
+
+    scheduler = Scheduler(pool_size=1, queue_size=2)
+    handles = scheduler.schedule([Job('task_1'), Job('task_1')])
+    scheduler.shutdown(drain=True, timeout=5)
+    assert all(handle.done() for handle in handles)
+    assert Scheduler.load_from_file() == []
+
+
+def test_job_compact_representation():
+    """Test compact job keeps the public attributes."""
+
+    task_1 = Job('task_1', uid='a' * 32)
+    task_2 = Job('task_2', start_time='01.02.2030 10:20:30', restarts=1,
+                 dependencies=[task_1])
+    assert not hasattr(task_2, '__dict__')
+    assert task_2.start_time == datetime(2030, 2, 1, 10, 20, 30)
+    assert task_2.task.__doc__ == 'Rename the file'
+    assert task_2.dependencies == [task_1]
+    assert task_2.dependency_uids == ['a' * 32]
+    assert Job('task_1', uid='custom').uid == 'custom'
+
+    restored = pickle.loads(pickle.dumps(task_2))
+    assert restored.uid == task_2.uid
+    assert restored.start_time == task_2.start_time
+    assert restored.worker is None
+
+    with pytest.raises(ValueError):
+        Job('task_1', start_time='2030-02-01')
+
+
+def test_job_custom_uid_kept():
+    """Test custom uids come back unchanged."""
+
+    for uid in ('A' * 32, '0x' + 'a' * 30, ' ' + 'a' * 31, 'a' * 32):
+        assert Job('task_1', uid=uid).uid == uid
+
+
+def test_job_legacy_state():
+    """Test job pickled by the dict based Job is restored."""
+
+    upstream = Job('task_1')
+    job = Job.__new__(Job)
+    job.__setstate__({
+        'task': TASKS['task_2'], 'start_time': datetime(2030, 2, 1, 10),
+        'duration': 3, 'restarts': 1, 'dependencies': [upstream],
+        'uid': 'b' * 32, 'worker': None,
+    })
+    assert job.task is TASKS['task_2']
+    assert job.start_time == datetime(2030, 2, 1, 10)
+    assert (job.duration, job.restarts) == (3, 1)
+    assert job.dependency_uids == [upstream.uid]
+    assert job.uid == 'b' * 32
+    assert not job.pass_results
+
+
+def test_job_create_many():
+    """Test bulk constructor creates jobs with the same settings."""
+
+    upstream = Job('task_1')
+    jobs = Job.create_many('task_3', 3, duration=1, dependencies=[upstream])
+    assert len({job.uid for job in jobs}) == 3
+    assert all(len(job.uid) == 32 for job in jobs)
+    assert all(job.dependency_uids == [upstream.uid] for job in jobs)
+    assert all(job.duration == 1 and job.start_time is None for job in jobs)
+
+
+def test_job_profiler_writes_profile(monkeypatch, tmp_path):
+    """Test selected task and its worker processes are profiled."""
+
+    monkeypatch.setitem(TASKS, 'abs_in_worker', abs_in_worker)
+    profiler = JobProfiler(
+        sample_rate=0, tasks={'abs_in_worker'}, profile_dir=str(tmp_path)
+    )
+    profiled = Job('abs_in_worker')
+    skipped = Job('task_1')
+    scheduler = Scheduler(pool_size=2, profiler=profiler)
+    handles = scheduler.schedule([profiled, skipped])
+    scheduler.run()
+    assert handles[0].result(timeout=5) == [1, 2]
+    assert os.listdir(tmp_path) == [profiled.uid]
+    files = os.listdir(tmp_path / profiled.uid)
+    assert {'job.pstats', 'job-allocations.txt'} <= set(files)
+    assert any(name.startswith('worker-') for name in files)
+
+
+def test_job_profiler_sample_rate():
+    """Test sampling profiles jobs only by the rate."""
+
+    assert JobProfiler(sample_rate=1).should_profile('uid', 'task_1')
+    assert not JobProfiler(sample_rate=0).should_profile('uid', 'task_1')
+    assert JobProfiler(sample_rate=0, uids={'uid'}).should_profile(
+        'uid', 'task_1'
+    )
+
+
+def test_job_profiler_keeps_external_tracing(tmp_path):
+    """Test profiler doesn't stop tracemalloc it didn't start."""
+
+    profiler = JobProfiler(sample_rate=1, profile_dir=str(tmp_path))
+    tracemalloc.start()
+    try:
+        with profiler.profile('uid', 'task_1'):
+            pass
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+    with profiler.profile('uid', 'task_1'):
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing()
+
+
+def test_runtime_stats_persisted(tmp_path):
+    """Test runtime stats are saved, loaded and suggest duration."""
+
+    path = str(tmp_path / 'stats.json')
+    stats = RuntimeStats(path)
+    assert stats.suggest_duration('task_1') is None
+    for seconds in (1.0, 2.0, 3.0):
+        stats.record('task_1', seconds)
+    stats.save()
+
+    loaded = RuntimeStats(path)
+    loaded.load()
+    assert loaded.estimate('task_1') == 2.0
+    assert loaded.suggest_duration('task_1') == 5
+    scheduler = Scheduler(pool_size=1, stats=loaded, auto_duration=True)
+    scheduler.submit(Job('task_1'))
+    assert scheduler.queue[0].duration == 5
+
+
+def test_scheduler_critical_path_first(tmp_path):
+    """Test ready job with the longest critical path is dispatched first."""
+
+    stats = RuntimeStats(str(tmp_path / 'stats.json'))
+    stats.record('task_3', 5.0)
+    stats.record('task_4', 5.0)
+    stats.record('task_1', 1.0)
+    short = Job('task_1')
+    head = Job('task_3')
+    tail = Job('task_4', dependencies=[head])
+    scheduler = Scheduler(pool_size=3, stats=stats)
+    scheduler.schedule([short, head, tail])
+    assert scheduler.get_job() is head
+    assert scheduler.queue == [short, tail]
+
+
+def test_scheduler_long_dependency_chain(tmp_path):
+    """Test critical path of a long chain is computed without recursion."""
+
+    chain = [Job('task_1')]
+    for _ in range(2999):
+        chain.append(Job('task_1', dependencies=[chain[-1]]))
+    short = Job('task_2')
+    scheduler = Scheduler(
+        pool_size=1, queue_size=len(chain) + 1,
+        stats=RuntimeStats(str(tmp_path / 'stats.json'))
+    )
+    scheduler.schedule([short] + chain[::-1])
+    assert scheduler.get_job() is chain[0]
+    assert scheduler.get_job() is short
+    assert scheduler.get_job() is None
+    assert len(scheduler.queue) == len(chain) - 1
+
+
+def make_city(city, temps):
+    """Make CityModel with two days of hourly forecasts."""
+
+    conditions = ('clear', 'rain', 'cloudy', 'snow')
+    days = [
+        {'date': f'2022-05-2{day}',
+         'hours': [{'hour': hour, 'temp': temps[day] + hour % 5,
+                    'condition': conditions[(hour + day) % 4]}
+                   for hour in range(24)]}
+        for day in range(2)
+    ]
+    days.append({'date': '2022-05-29', 'hours': []})
+    return CityModel(city=city, forecasts={'forecasts': days})
+
+
+def test_task_11_shared_memory_matches_models():
+    """Test shared memory transport gives the same rating as models."""
+
+    forecasts = [make_city('MOSCOW', (10, 12)), make_city('PARIS', (15, 3)),
+                 make_city('CAIRO', (30, 31))]
+    expected = DataCalculationTask().adding_rating(
+        map(DataCalculationTask().general_calculation, forecasts)
+    )
+    assert task_11(forecasts) == expected
+
+
+def test_scheduler_shutdown_while_running(monkeypatch):
+    """
+    Test shutdown from another thread returns by the timeout, saves the
+    preempted and queued jobs and the active run doesn't overwrite them.
+    """
+
+    monkeypatch.setitem(TASKS, 'sleep', sleep_a_second)
+    scheduler = Scheduler(pool_size=3)
+    scheduler.schedule([Job('sleep'), Job('sleep'), Job('sleep')])
+    runner = Thread(target=scheduler.run, daemon=True)
+    runner.start()
+    time.sleep(0.2)
+    started = time.monotonic()
+    scheduler.shutdown(drain=True, timeout=0.5)
+    assert time.monotonic() - started < 2
+    runner.join(timeout=2)
+    assert not runner.is_alive()
+    assert len(Scheduler.load_from_file()) == 3
+    Scheduler.save_to_file([])
+
+
+def test_scheduler_shutdown_wakes_blocked_submit():
+    """Test producer blocked in submit gives up on shutdown."""
+
+    scheduler = Scheduler(pool_size=1)
+    scheduler.submit(Job('task_1'))
+    handles = []
+    producer = Thread(
+        target=lambda: handles.append(scheduler.submit(Job('task_1'))),
+        daemon=True
+    )
+    producer.start()
+    time.sleep(0.1)
+    scheduler.shutdown(drain=False)
+    producer.join(timeout=1)
+    assert handles == [None]
+    assert len(Scheduler.load_from_file()) == 1
+    Scheduler.save_to_file([])
+
+
 def test_delete_files_after_test():
     """Delete tests files after all tests"""
 
     os.remove(FILE)
     os.remove(RENAMED_FILE)
+    shutil.rmtree(RESULTS_DIR, ignore_errors=True)
+    os.remove(RUNTIME_STATS)